@@ -1,19 +1,24 @@
 import os
 import logging
 import asyncio
+import hashlib
+import html
+import queue
 import re
-from datetime import datetime
-from typing import List, Dict, Any
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple
 
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.types import Message, Chat
 from aiogram.enums import ParseMode
-from cerebras.cloud.sdk import Cerebras
 from dotenv import load_dotenv
 from peewee import (
-    SqliteDatabase, Model, AutoField, TextField, DateTimeField, IntegerField,
-    ForeignKeyField, DoesNotExist
+    SqliteDatabase, Model, AutoField, TextField, IntegerField,
+    ForeignKeyField, EXCLUDED, Value, fn
 )
 from telegraph import Telegraph
 from telegraph.exceptions import TelegraphException
@@ -28,14 +33,59 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 bot = Bot(token=os.getenv("TELEGRAM_BOT_TOKEN"))
 dp = Dispatcher()
 
-# Initialize Cerebras client
-cerebras_client = Cerebras(api_key=os.getenv("CEREBRAS_API_KEY"))
+# Cerebras client; the SDK is imported and the client created on first use (see get_cerebras_client)
+cerebras_client = None
+# Telegraph client for long answers; its account is created once and the token kept in the Config table
+telegraph_client = None
+TELEGRAPH_TOKEN_KEY = 'telegraph_token'
 
 DEFAULT_MESSAGE_COUNT = 100
+MAX_MESSAGE_COUNT = 500 # Largest n accepted by /history and /qwen
 CEREBRAS_MODEL = "qwen-3-235b-a22b-thinking-2507"
+SAVE_BATCH_SIZE = 100 # Max messages written per transaction
+SAVE_FLUSH_INTERVAL = 0.2 # Seconds to wait for more messages before flushing a batch
+HISTORY_CACHE_SIZE = 128 # Formatted chat histories kept in memory
+CEREBRAS_MAX_CONCURRENCY = 8 # Max Cerebras requests in flight at once
+LLM_CACHE_TTL = 6 * 60 * 60 # Seconds a cached /history or /qwen response stays valid
+HISTORY_TOKEN_BUDGET = 30000 # Approximate max tokens of chat history sent to the model
+CHARS_PER_TOKEN = 4 # Rough estimate used to count tokens without a tokenizer
+
+# Tags that close the model's reasoning block; the answer follows the first one found
+THINKING_TAG_RE = re.compile(r'</think>|</reasoning>|<\|im_end\|>')
+# Labels the model uses to introduce its final answer in /qwen responses, longest first
+FINAL_ANSWER_LABELS = (
+    r'Финальный\s+(?:Ответ|Вывод)|Final\s+(?:Answer|Response)|Итоговый\s+ответ|Ответ\s+на\s+вопрос'
+    r'|Summary|Вывод|Ответ|Итог|Решение|Результат|Заключение'
+)
+# A label counts as a '###' heading, followed by a colon, or (for a few capitalized labels,
+# case-sensitive) alone at the start of a line, so ordinary mentions like "the summary of" don't
+FINAL_ANSWER_RE = re.compile(
+    rf'###\s*(?:{FINAL_ANSWER_LABELS})\b\s*:?'
+    rf'|\b(?:{FINAL_ANSWER_LABELS})\s*:'
+    r'|^(?-i:Итоговый\s+ответ|Ответ\s+на\s+вопрос|Summary)\b',
+    re.IGNORECASE | re.MULTILINE,
+)
 
 # --- Database Setup ---
-db = SqliteDatabase('chat_history.db')
+# autoconnect is off: the main thread and the writer thread each open one connection and keep it,
+# so the pragmas below are applied once per connection rather than on every implicit reconnect.
+db = SqliteDatabase(
+    'chat_history.db',
+    autoconnect=False,
+    pragmas={
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'temp_store': 'memory',
+        'cache_size': -64000, # ~64 MB page cache
+        'foreign_keys': 1,
+        'mmap_size': 268435456, # 256 MB
+    },
+)
+
+# Messages waiting to be written by the writer thread; None asks it to stop
+pending_messages: queue.Queue = queue.Queue()
+# chat_id -> chat_title already stored in the Chat table (writer thread only)
+known_chats: Dict[int, Optional[str]] = {}
 
 class BaseModel(Model):
     class Meta:
@@ -54,93 +104,187 @@ class ChatMessage(BaseModel):
     first_name = TextField()
     last_name = TextField(null=True)
     text = TextField()
-    date = DateTimeField()
+    date_ts = IntegerField() # Unix timestamp, seconds (UTC)
+
+    class Meta:
+        # Serves the per-chat "latest N messages" lookup in get_chat_history_from_db
+        indexes = (
+            (('chat', 'date_ts'), False),
+        )
+
+class LLMCache(BaseModel):
+    key = TextField(primary_key=True) # sha256 of the model, system prompt, chat history and request, see llm_cache_key()
+    response = TextField()
+    created_ts = IntegerField(index=True) # Unix timestamp, seconds
+
+class Config(BaseModel):
+    key = TextField(primary_key=True) # e.g. TELEGRAPH_TOKEN_KEY
+    value = TextField()
+
+def migrate_message_dates():
+    """Converts the ISO-8601 text 'date' column of older databases to the integer 'date_ts' column."""
+    from playhouse.migrate import SqliteMigrator, migrate
+
+    logging.info("Migrating chatmessage.date to integer date_ts...")
+    migrator = SqliteMigrator(db)
+    with db.atomic():
+        migrate(migrator.add_column('chatmessage', 'date_ts', IntegerField(null=True)))
+        # Rows whose date can't be parsed get 0 rather than NULL so they still sort and render
+        db.execute_sql(
+            "UPDATE chatmessage SET date_ts = COALESCE(CAST(strftime('%s', date) AS INTEGER), 0)"
+        )
+        db.execute_sql('DROP INDEX IF EXISTS chatmessage_chat_id_date')
+        migrate(
+            migrator.drop_column('chatmessage', 'date'),
+            # Match the NOT NULL column that create_tables() gives new databases
+            migrator.add_not_null('chatmessage', 'date_ts'),
+        )
+    logging.info("Migration of chatmessage dates finished.")
 
 def initialize_db():
-    """Connects to the database and creates tables."""
+    """Connects to the database, migrates older schemas and creates tables."""
     logging.info("Connecting to the database and creating tables if they don't exist.")
-    db.connect()
-    db.create_tables([Chat, ChatMessage])
+    db.connect(reuse_if_open=True)
+    journal_mode = db.execute_sql('PRAGMA journal_mode').fetchone()[0]
+    if journal_mode != 'wal':
+        logging.warning(f"SQLite journal_mode is '{journal_mode}' instead of 'wal'; writes will block history reads.")
+    if db.table_exists('chatmessage'):
+        columns = {column.name for column in db.get_columns('chatmessage')}
+        if 'date' in columns and 'date_ts' not in columns:
+            migrate_message_dates()
+    db.create_tables([Chat, ChatMessage, LLMCache, Config])
+    writer_thread.start()
     logging.info("Database initialized successfully.")
 
-async def save_message_to_db(message: Message):
-    """Saves a text message to the database."""
+def save_message_to_db(message: Message):
+    """Queues a text message to be saved to the database by the writer thread."""
     if not message.text or not message.chat: # Skip empty messages or non-chat updates
         return
 
+    pending_messages.put_nowait({
+        'chat': message.chat.id,
+        'chat_title': message.chat.title,
+        'chat_type': message.chat.type,
+        'user_id': message.from_user.id,
+        'username': message.from_user.username,
+        'first_name': message.from_user.first_name,
+        'last_name': message.from_user.last_name,
+        'text': message.text,
+        'date_ts': int(message.date.timestamp()),
+    })
+
+# Written with a plain executemany: peewee's insert_many converts every field of every row in Python,
+# which made up most of the time spent writing a batch. Parameters are the keys of the queued dicts.
+INSERT_MESSAGE_SQL = (
+    'INSERT INTO chatmessage (chat_id, user_id, username, first_name, last_name, text, date_ts) '
+    'VALUES (:chat, :user_id, :username, :first_name, :last_name, :text, :date_ts)'
+)
+
+def flush_messages(rows: List[Dict[str, Any]]):
+    """Writes a batch of queued messages to the database in a single transaction."""
+    chats = {}
+    for row in rows:
+        chats[row['chat']] = (row.pop('chat_title'), row.pop('chat_type'))
+
+    with db.atomic():
+        for chat_id, (chat_title, chat_type) in chats.items():
+            if chat_id not in known_chats:
+                (
+                    Chat
+                    .insert(chat_id=chat_id, chat_title=chat_title, chat_type=chat_type)
+                    .on_conflict(
+                        conflict_target=[Chat.chat_id],
+                        update={Chat.chat_title: EXCLUDED.chat_title},
+                    )
+                    .execute()
+                )
+            elif known_chats[chat_id] != chat_title:
+                # Only the title of a stored chat can change
+                Chat.update(chat_title=chat_title).where(Chat.chat_id == chat_id).execute()
+
+        db.cursor().executemany(INSERT_MESSAGE_SQL, rows)
+    known_chats.update((chat_id, chat_title) for chat_id, (chat_title, _) in chats.items())
+
+def message_writer():
+    """
+    Writer thread loop. Owns its own DB connection and writes pending_messages in batches,
+    flushing every SAVE_FLUSH_INTERVAL seconds or once SAVE_BATCH_SIZE messages are queued.
+    """
+    db.connect(reuse_if_open=True)
     try:
-        chat_obj, created = Chat.get_or_create(
-            chat_id=message.chat.id,
-            defaults={
-                'chat_title': message.chat.title,
-                'chat_type': message.chat.type
-            }
-        )
-        if not created and message.chat.title != chat_obj.chat_title:
-            chat_obj.chat_title = message.chat.title
-            chat_obj.save()
-
-        ChatMessage.create(
-            chat=chat_obj,
-            user_id=message.from_user.id,
-            username=message.from_user.username,
-            first_name=message.from_user.first_name,
-            last_name=message.from_user.last_name,
-            text=message.text,
-            date=message.date
-        )
-        # logging.info(f"Saved message from {message.from_user.first_name} in chat {message.chat.id}")
-    except Exception as e:
-        logging.error(f"Error saving message to DB: {e}", exc_info=True)
+        # Chats saved by earlier runs need no upsert until their title changes
+        try:
+            known_chats.update(Chat.select(Chat.chat_id, Chat.chat_title).tuples())
+        except Exception as e:
+            # Not fatal: unknown chats are upserted on their first message anyway
+            logging.error(f"Error loading known chats from DB: {e}", exc_info=True)
+        stopping = False
+        while not stopping:
+            row = pending_messages.get()
+            if row is None:
+                break
+            rows = [row]
+            deadline = time.monotonic() + SAVE_FLUSH_INTERVAL
+            while len(rows) < SAVE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    row = pending_messages.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                rows.append(row)
+
+            try:
+                flush_messages(rows)
+            except Exception as e:
+                logging.error(f"Error saving {len(rows)} messages to DB: {e}", exc_info=True)
+    finally:
+        db.close()
 
-def get_chat_history_from_db(chat_id: int, limit: int) -> List[Dict[str, Any]]:
+writer_thread = threading.Thread(target=message_writer, name='db-writer', daemon=True)
+
+def stop_message_writer():
+    """Asks the writer thread to flush what is queued and waits for it to exit."""
+    if writer_thread.is_alive():
+        pending_messages.put(None)
+        writer_thread.join()
+
+def get_chat_history_from_db(chat_id: int, limit: int) -> List[Tuple[str, str, str]]:
     """
     Fetches the last 'limit' messages for a given chat_id from the database.
-    Returns a list of dictionaries, sorted chronologically (oldest first).
+    Returns (sender_name, text, date) tuples, sorted chronologically (oldest first),
+    with date already formatted as 'YYYY-MM-DD HH:MM:SS' (UTC).
     """
-    history = []
     try:
-        chat_obj = Chat.get_by_id(chat_id)
-        # Fetch messages ordered by date descending (newest first), then limit
-        messages = (
+        # The sender name and the date string are built by SQLite: "first_name last_name", or just first_name
+        sender_name = ChatMessage.first_name.concat(
+            fn.COALESCE(Value(' ').concat(fn.NULLIF(ChatMessage.last_name, '')), '')
+        )
+        date = fn.strftime('%Y-%m-%d %H:%M:%S', ChatMessage.date_ts, 'unixepoch')
+        # Pick the ids of the newest messages from the (chat, date_ts) index alone, then fetch
+        # just those rows by primary key, in chronological order
+        latest_ids = (
             ChatMessage
-            .select()
-            .where(ChatMessage.chat == chat_obj)
-            .order_by(ChatMessage.date.desc())
+            .select(ChatMessage.message_id)
+            .where(ChatMessage.chat == chat_id)
+            .order_by(ChatMessage.date_ts.desc())
             .limit(limit)
         )
+        history = list(
+            ChatMessage
+            .select(sender_name, ChatMessage.text, date)
+            .where(ChatMessage.message_id.in_(latest_ids))
+            .order_by(ChatMessage.date_ts)
+            .tuples()
+        )
 
-        for msg in messages:
-            sender_name = msg.first_name
-            if msg.last_name:
-                sender_name += f" {msg.last_name}"
-            # if msg.username: # Optional: add username
-            #     sender_name += f" (@{msg.username})"
-
-            message_date = msg.date
-            if isinstance(message_date, str):
-                try:
-                    message_date = datetime.fromisoformat(message_date)
-                except ValueError:
-                    logging.warning(
-                        f"Could not parse date string: {message_date} for message_id {msg.message_id}"
-                    )
-                    # Fallback to current time or skip, for now, let's use current time to avoid crashing
-                    message_date = datetime.now()
-
-            history.append(
-                {
-                    "sender_name": sender_name,
-                    "text": msg.text,
-                    "date": message_date,
-                }
-            )
-
-        # Messages are fetched newest to oldest, reverse for chronological order
-        return history[::-1]
-    except DoesNotExist:
-        logging.info(f"No chat found in DB with id: {chat_id}")
-        return []
+        if not history:
+            logging.info(f"No messages found in DB for chat: {chat_id}")
+        return history
     except Exception as e:
         logging.error(
             f"Error fetching chat history from DB for chat {chat_id}: {e}",
@@ -148,57 +292,177 @@ def get_chat_history_from_db(chat_id: int, limit: int) -> List[Dict[str, Any]]:
         )
         return []
 
-# --- Cerebras API Interaction ---
-async def call_cerebras_api(prompt: str, is_qwen_command: bool = False) -> str:
+@lru_cache(maxsize=HISTORY_CACHE_SIZE)
+def _format_history(chat_id: int, max_message_id: int, limit: int) -> str:
     """
-    Sends a prompt to the Cerebras API and returns the response.
+    Loads and formats the last 'limit' messages of a chat as prompt lines, keeping the newest
+    messages that fit into HISTORY_TOKEN_BUDGET.
+    Cached per newest stored message_id, so any new message in the chat yields a fresh key.
+    """
+    chat_history = get_chat_history_from_db(chat_id, limit)
+    if not chat_history:
+        # Raising rather than returning "" keeps lru_cache from storing the result of a failed read
+        raise LookupError(f"Could not read the history of chat {chat_id}")
+    lines = deque()
+    tokens = 0
+    # Walk from the newest message back so that, if the budget runs out, the oldest messages are dropped
+    for sender_name, text, date in reversed(chat_history):
+        line = f"{sender_name} ({date}): {text}"
+        tokens += len(line) // CHARS_PER_TOKEN + 1
+        if tokens > HISTORY_TOKEN_BUDGET:
+            logging.info(
+                f"History for chat {chat_id} truncated to the newest {len(lines)} of {len(chat_history)} messages "
+                f"to fit the {HISTORY_TOKEN_BUDGET} token budget"
+            )
+            break
+        lines.appendleft(line)
+    return "\n".join(lines)
+
+def get_formatted_history(chat_id: int, limit: int) -> str:
+    """
+    Returns the formatted last 'limit' messages of a chat, or "" if the chat has no history.
+    The newest stored message_id keys the _format_history cache.
     """
     try:
-        logging.info(f"Sending prompt to Cerebras: {prompt[:200]}...")
-        
-        system_prompt_content = (
-            "Ты — полезный ассистент. Отвечай на русском языке, если в запросе используется русский язык. "
-            "Будь краток, по существу. "
-            "Используй только разметку MarkdownV2, поддерживаемую Telegram: **жирный**, __курсив__, `код`, ~~перечеркнутый~~, ```блок кода```, ||скрытый текст||. "
-            "Не используй HTML или другие форматы разметки. "
-            "Не экранируй специальные символы MarkdownV2 (например, не ставь \\ перед *, _, ~, `, |). "
-            "Пиши текст напрямую с нужной разметкой без экранирования."
+        max_message_id = (
+            ChatMessage
+            .select(fn.MAX(ChatMessage.message_id))
+            .where(ChatMessage.chat == chat_id)
+            .scalar()
         )
+    except Exception as e:
+        logging.error(f"Error fetching latest message id for chat {chat_id}: {e}", exc_info=True)
+        return ""
 
-        if is_qwen_command:
-            system_prompt_content += (
-                " Если для ответа на вопрос пользователя в предоставленных сообщениях чата нет информации, "
-                "отвечай на вопрос самостоятельно, используя свои знания."
-                "Никогда не отвечай на вопрос в формате [Информации о ... в предоставленных сообщениях чата нет.]"
-                "Всегда отвечай на вопрос, даже если он не связан с чатом."
-                "Не пиши, что в чате нет информации, если в чате нет информации, генерирует ответ, не опираясь на нее."
-                "То есть решение задачи превыше информации в чате. Даже если в чате информация не полная,"
-                "то на ее основе дополняй информацию и генерирует ответ."
-            )
-        else:  # For /history command
-            system_prompt_content += (
-                "Предоставляй сводки, основываясь *только* на предоставленном контексте чата. "
-                "Не добавляй информацию, отсутствующую в чате."
-            )
+    if max_message_id is None:
+        logging.info(f"No messages found in DB for chat: {chat_id}")
+        return ""
+
+    try:
+        return _format_history(chat_id, max_message_id, limit)
+    except LookupError:
+        return ""
 
-        chat_completion = cerebras_client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_prompt_content},
-                {"role": "user", "content": prompt}
-            ],
-            model=CEREBRAS_MODEL,
+def normalize_question(question: str) -> str:
+    """Normalizes a /qwen question for cache lookups (case, whitespace, trailing punctuation)."""
+    return " ".join(question.casefold().split()).rstrip("?!. ")
+
+def llm_cache_key(system_prompt: str, history: str, request: str) -> str:
+    """Hashes everything that determines a model response into an LLMCache key."""
+    key_material = "\x00".join((CEREBRAS_MODEL, system_prompt, history, request))
+    return hashlib.sha256(key_material.encode()).hexdigest()
+
+def get_cached_llm_response(key: str) -> Optional[str]:
+    """Returns a cached model response younger than LLM_CACHE_TTL, if any."""
+    try:
+        return (
+            LLMCache
+            .select(LLMCache.response)
+            .where((LLMCache.key == key) & (LLMCache.created_ts > int(time.time()) - LLM_CACHE_TTL))
+            .scalar()
         )
+    except Exception as e:
+        logging.error(f"Error reading LLM response cache: {e}", exc_info=True)
+        return None
+
+def cache_llm_response(key: str, response: str):
+    """Stores a model response and drops entries that have outlived LLM_CACHE_TTL."""
+    now = int(time.time())
+    try:
+        with db.atomic():
+            LLMCache.delete().where(LLMCache.created_ts <= now - LLM_CACHE_TTL).execute()
+            LLMCache.insert(key=key, response=response, created_ts=now).on_conflict_replace().execute()
+    except Exception as e:
+        logging.error(f"Error writing LLM response cache: {e}", exc_info=True)
+
+# --- Cerebras API Interaction ---
+# System prompts are built once so they are byte-identical across calls (cacheable prefix)
+SYSTEM_PROMPT_BASE = (
+    "Ты — полезный ассистент. Отвечай на русском языке, если в запросе используется русский язык. "
+    "Будь краток, по существу. "
+    "Используй только разметку MarkdownV2, поддерживаемую Telegram: **жирный**, __курсив__, `код`, ~~перечеркнутый~~, ```блок кода```, ||скрытый текст||. "
+    "Не используй HTML или другие форматы разметки. "
+    "Не экранируй специальные символы MarkdownV2 (например, не ставь \\ перед *, _, ~, `, |). "
+    "Пиши текст напрямую с нужной разметкой без экранирования."
+)
+# The task instructions live here too, so the user messages carry only the chat history and the question
+SYSTEM_PROMPT_QWEN = SYSTEM_PROMPT_BASE + (
+    " Если для ответа на вопрос пользователя в предоставленных сообщениях чата нет информации, "
+    "отвечай на вопрос самостоятельно, используя свои знания."
+    "Никогда не отвечай на вопрос в формате [Информации о ... в предоставленных сообщениях чата нет.]"
+    "Всегда отвечай на вопрос, даже если он не связан с чатом."
+    "Не пиши, что в чате нет информации, если в чате нет информации, генерирует ответ, не опираясь на нее."
+    "То есть решение задачи превыше информации в чате. Даже если в чате информация не полная,"
+    "то на ее основе дополняй информацию и генерирует ответ. "
+    "Основываясь на предоставленных сообщениях чата (в хронологическом порядке, сначала самые старые), "
+    "кратко и точно ответь на вопрос пользователя из последнего сообщения. Отвечай на русском языке. "
+    "Выводи только финальный ответ, без своих рассуждений."
+)
+SYSTEM_PROMPT_HISTORY = SYSTEM_PROMPT_BASE + (
+    "Предоставляй сводки, основываясь *только* на предоставленном контексте чата. "
+    "Не добавляй информацию, отсутствующую в чате. "
+    "Проанализируй предоставленные сообщения чата, которые идут в хронологическом порядке (сначала самые старые). "
+    "Предоставь краткую и информативную сводку последних новостей или важных обсуждений. "
+    "Сосредоточься на ключевых моментах, решениях или обновлениях. Избегай ненужных деталей и 'воды'. "
+    "Не упоминай, что ты суммируй чат, просто предоставь сводку напрямую на русском языке. "
+    "Выводи только финальный ответ, без своих рассуждений."
+)
+
+def create_cerebras_client():
+    """Imports the Cerebras SDK and creates the async client; blocking, see get_cerebras_client."""
+    from cerebras.cloud.sdk import AsyncCerebras
+    return AsyncCerebras(api_key=os.getenv("CEREBRAS_API_KEY"))
+
+# Serializes the first use of Cerebras so that concurrent first requests don't each create a client
+cerebras_lock = asyncio.Lock()
+
+async def get_cerebras_client():
+    """Returns the async Cerebras client, creating it on first use."""
+    global cerebras_client
+    async with cerebras_lock:
+        if cerebras_client is None:
+            # Creating the client makes a blocking TCP warm-up request, so do it in a worker thread
+            cerebras_client = await asyncio.to_thread(create_cerebras_client)
+    return cerebras_client
+
+# Caps concurrent Cerebras requests to respect provider rate limits and control cost
+cerebras_semaphore = asyncio.Semaphore(CEREBRAS_MAX_CONCURRENCY)
+
+CEREBRAS_ERROR_RESPONSE = "Извините, произошла ошибка при обработке вашего запроса сервисом ИИ."
+
+async def call_cerebras_api(prompt: str, is_qwen_command: bool = False, history: str = "") -> str:
+    """
+    Sends a prompt to the Cerebras API and returns the response.
+    The chat history, if given, goes in its own message ahead of the prompt so the
+    system prompt and the (append-only) history form a stable request prefix.
+    An empty prompt sends the history alone (the system prompt carries the task).
+    """
+    try:
+        logging.info(f"Sending prompt to Cerebras with {len(history)} chars of history: {prompt[:200]}...")
+
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT_QWEN if is_qwen_command else SYSTEM_PROMPT_HISTORY},
+        ]
+        if history:
+            messages.append({"role": "user", "content": f"Сообщения чата:\n{history}"})
+        if prompt:
+            messages.append({"role": "user", "content": prompt})
+
+        async with cerebras_semaphore:
+            client = await get_cerebras_client()
+            chat_completion = await client.chat.completions.create(
+                messages=messages,
+                model=CEREBRAS_MODEL,
+            )
         response_content = chat_completion.choices[0].message.content
         logging.info(f"Raw Cerebras response: {response_content[:500]}...")
 
         final_response = response_content.strip()
 
-        thinking_tags = ["</think>", "</reasoning>", "<|im_end|>"]
-        for tag in thinking_tags:
-            if tag in final_response:
-                logging.info(f"Found thinking tag '{tag}', splitting response.")
-                final_response = final_response.split(tag, 1)[-1].strip()
-                break
+        thinking_tag = THINKING_TAG_RE.search(final_response)
+        if thinking_tag:
+            logging.info(f"Found thinking tag '{thinking_tag.group()}', splitting response.")
+            final_response = final_response[thinking_tag.end():].strip()
         else:
             logging.info("No thinking tag found, returning the full response.")
 
@@ -206,21 +470,102 @@ async def call_cerebras_api(prompt: str, is_qwen_command: bool = False) -> str:
         return final_response
     except Exception as e:
         logging.error(f"Error calling Cerebras API: {type(e).__name__} - {e}", exc_info=True)
-        return "Извините, произошла ошибка при обработке вашего запроса сервисом ИИ."
+        return CEREBRAS_ERROR_RESPONSE
 
-def escape_markdown(text: str) -> str:
-    """Escape special characters for Telegram MarkdownV2."""
-    # List of characters that need escaping in MarkdownV2
-    escape_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    
-    # First, escape backslashes to avoid double escaping
-    text = text.replace('\\', '\\\\')
-    
-    # Then escape all special characters
-    for char in escape_chars:
-        text = text.replace(char, f'\\{char}')
-    
-    return text
+def extract_final_answer(answer: str) -> str:
+    """
+    Returns the part of a /qwen answer after the last final-answer heading, if any.
+    The full answer is kept when nothing follows the heading.
+    """
+    final_marker = None
+    for final_marker in FINAL_ANSWER_RE.finditer(answer):
+        pass
+    if final_marker:
+        final_answer = answer[final_marker.end():].strip()
+    elif "###" in answer:
+        final_answer = answer.split("###", 1)[1].strip()
+    else:
+        # If none of the above patterns are found, the full answer is sent as is.
+        return answer
+    return final_answer or answer
+
+async def run_llm_on_history(
+    chat_id: int, limit: int, question: Optional[str] = None
+) -> Optional[str]:
+    """
+    Runs the model over the last 'limit' saved messages of a chat and returns its answer.
+    Without a question this produces a /history summary; with one, a /qwen answer.
+    Answers are cached per chat history and normalized question.
+    Returns None if there is no saved history for the chat.
+    """
+    formatted_history = get_formatted_history(chat_id, limit)
+    if not formatted_history:
+        return None
+
+    is_qwen_command = question is not None
+    system_prompt = SYSTEM_PROMPT_QWEN if is_qwen_command else SYSTEM_PROMPT_HISTORY
+    cache_key = llm_cache_key(system_prompt, formatted_history, normalize_question(question) if is_qwen_command else "")
+    cached_answer = get_cached_llm_response(cache_key)
+    if cached_answer:
+        return cached_answer
+
+    prompt = f"Вопрос пользователя: {question}" if is_qwen_command else ""
+    answer = await call_cerebras_api(prompt, is_qwen_command=is_qwen_command, history=formatted_history)
+    if answer == CEREBRAS_ERROR_RESPONSE:
+        return answer
+
+    if is_qwen_command:
+        answer = extract_final_answer(answer)
+    if not answer.strip():
+        # Telegram rejects empty messages; report an error and let the next request ask the model again
+        logging.warning(f"Cerebras returned an empty answer for chat {chat_id}")
+        return CEREBRAS_ERROR_RESPONSE
+    cache_llm_response(cache_key, answer)
+    return answer
+
+# Characters that must be escaped in MarkdownV2 text, and inside `code`/```pre``` entities
+MDV2_TRANS = str.maketrans({c: '\\' + c for c in '\\_*[]()~`>#+-=|{}.!'})
+MDV2_CODE_TRANS = str.maketrans({'`': '\\`', '\\': '\\\\'})
+
+# Markup the model is asked to use (see SYSTEM_PROMPT_BASE); anything else is sent as plain text
+TELEGRAM_MARKUP_RE = re.compile(
+    r'(?s:```(.*?)```)|`([^`\n]+)`|\*\*(.+?)\*\*|__(.+?)__|~~(.+?)~~|\|\|(.+?)\|\|'
+)
+
+def convert_telegram_markup_to_markdown_v2(text: str) -> str:
+    """
+    Converts the model's markup (**bold**, __italic__, ~~strike~~, ||spoiler||, `code`, ```pre```)
+    to valid Telegram MarkdownV2, escaping all other special characters.
+    Unpaired markers are escaped too, so the result always parses and needs no plain-text resend.
+    """
+    parts = []
+    position = 0
+    for match in TELEGRAM_MARKUP_RE.finditer(text):
+        parts.append(text[position:match.start()].translate(MDV2_TRANS))
+        code_block, code, bold, italic, strike, spoiler = match.groups()
+        if code_block is not None:
+            parts.append(f"```{code_block.translate(MDV2_CODE_TRANS)}```")
+        elif code is not None:
+            parts.append(f"`{code.translate(MDV2_CODE_TRANS)}`")
+        elif bold is not None:
+            parts.append(f"*{bold.translate(MDV2_TRANS)}*")
+        elif italic is not None:
+            parts.append(f"_{italic.translate(MDV2_TRANS)}_")
+        elif strike is not None:
+            parts.append(f"~{strike.translate(MDV2_TRANS)}~")
+        else:
+            parts.append(f"||{spoiler.translate(MDV2_TRANS)}||")
+        position = match.end()
+    parts.append(text[position:].translate(MDV2_TRANS))
+    return "".join(parts)
+
+# Patterns for convert_telegram_markup_to_html, applied in this order
+HTML_CODEBLOCK_RE = re.compile(r'```(.*?)```', re.DOTALL)
+HTML_BOLD_RE = re.compile(r'\*\*(.*?)\*\*')
+HTML_ITALIC_RE = re.compile(r'__(.*?)__')
+HTML_STRIKE_RE = re.compile(r'~~(.*?)~~')
+HTML_CODE_RE = re.compile(r'`([^`]+)`')
+HTML_SPOILER_RE = re.compile(r'\|\|(.*?)\|\|')
 
 def convert_telegram_markup_to_html(text: str) -> str:
     """
@@ -236,52 +581,75 @@ def convert_telegram_markup_to_html(text: str) -> str:
     - ||скрытый текст|| (заменяет на курсив с пометкой)
     """
     # Сначала экранируем все HTML специальные символы, чтобы предотвратить проблемы
-    import html
     text = html.escape(text)
     
     # Важно обрабатывать блоки кода первыми, чтобы их содержимое не форматировалось
     # Используем нежадный поиск и учитываем, что содержимое уже экранировано
-    text = re.sub(r'```(.*?)```', r'<pre><code>\1</code></pre>', text, flags=re.DOTALL)
+    text = HTML_CODEBLOCK_RE.sub(r'<pre><code>\1</code></pre>', text)
     
     # Теперь обрабатываем остальные теги, работая с уже экранированным текстом
-    text = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', text)
-    text = re.sub(r'__(.*?)__', r'<em>\1</em>', text)
-    text = re.sub(r'~~(.*?)~~', r'<s>\1</s>', text)
-    text = re.sub(r'`([^`]+)`', r'<code>\1</code>', text)
+    text = HTML_BOLD_RE.sub(r'<strong>\1</strong>', text)
+    text = HTML_ITALIC_RE.sub(r'<em>\1</em>', text)
+    text = HTML_STRIKE_RE.sub(r'<s>\1</s>', text)
+    text = HTML_CODE_RE.sub(r'<code>\1</code>', text)
     
     # Обработка спойлера: заменяем на компромиссный вариант
-    text = re.sub(r'\|\|(.*?)\|\|', r'<em>[скрытый текст: \1]</em>', text)
+    text = HTML_SPOILER_RE.sub(r'<em>[скрытый текст: \1]</em>', text)
     
     # Заменяем переносы строк на <br> для корректного отображения
     text = text.replace('\n', '<br>')
     
     return text
 
-async def send_long_message(message: Message, text: str, parse_mode: ParseMode = None) -> Message:
+# Serializes the first use of Telegraph so that concurrent long answers don't each create an account
+telegraph_lock = asyncio.Lock()
+
+async def get_telegraph_client() -> Telegraph:
+    """
+    Returns the Telegraph client, using the access token saved in the Config table.
+    On first use the account is created (off the event loop) and its token is saved for later runs.
+    """
+    global telegraph_client
+    async with telegraph_lock:
+        if telegraph_client is None:
+            saved_token = Config.get_or_none(Config.key == TELEGRAPH_TOKEN_KEY)
+            if saved_token is not None:
+                telegraph_client = Telegraph(access_token=saved_token.value)
+            else:
+                client = Telegraph()
+                await asyncio.to_thread(client.create_account, short_name='TG_Bot_Helper')
+                Config.replace(key=TELEGRAPH_TOKEN_KEY, value=client.get_access_token()).execute()
+                logging.info("Created a Telegraph account and saved its access token.")
+                telegraph_client = client
+    return telegraph_client
+
+async def send_long_message(message: Message, text: str, parse_mode: ParseMode = None, edit: bool = False) -> Message:
     """
     Отправляет сообщение, используя Telegraph статью, если текст превышает лимит Telegram (4096 символов).
+    Если edit=True, message — собственное сообщение бота, и оно редактируется вместо отправки ответа.
     """
     # Максимальная длина сообщения в Telegram
     TELEGRAM_MESSAGE_LIMIT = 4096
+    send = message.edit_text if edit else message.reply
     
     # Если текст короче лимита, отправляем обычным способом
     if len(text) <= TELEGRAM_MESSAGE_LIMIT:
-        return await message.reply(text, parse_mode=parse_mode)
+        if parse_mode == ParseMode.MARKDOWN_V2:
+            # Разметка модели приводится к корректному MarkdownV2 заранее, без повторной отправки при ошибке
+            return await send(convert_telegram_markup_to_markdown_v2(text), parse_mode=parse_mode)
+        return await send(text, parse_mode=parse_mode)
     
     # Если текст длиннее лимита, создаем Telegraph статью
     try:
-        telegraph = Telegraph()
-        # Создаем временный аккаунт
-        response = telegraph.create_account(short_name='TG_Bot_Helper')
-        access_token = response['access_token']
-        
-        client = Telegraph(access_token=access_token)
+        # Аккаунт создается один раз, его токен хранится в базе
+        client = await get_telegraph_client()
         
         # Конвертируем Telegram разметку в HTML
         html_content = convert_telegram_markup_to_html(text)
         
-        # Публикуем статью
-        page = client.create_page(
+        # Публикуем статью в отдельном потоке, чтобы не блокировать цикл событий
+        page = await asyncio.to_thread(
+            client.create_page,
             title="Ответ от ИИ",
             html_content=html_content
         )
@@ -289,73 +657,51 @@ async def send_long_message(message: Message, text: str, parse_mode: ParseMode =
         published_url = page['url']
         
         # Отправляем ссылку на статью
-        response_msg = await message.reply(
+        response_msg = await send(
             f"Ответ слишком длинный для отправки в Telegram. Вы можете прочитать его по ссылке: {published_url}",
             parse_mode=None
         )
         return response_msg
     except TelegraphException as e:
         logging.error(f"Telegraph API error: {e}")
-        # Если не удалось создать статью, отправляем урезанную версию сообщения
-        return await message.reply(text[:TELEGRAM_MESSAGE_LIMIT], parse_mode=parse_mode)
+        # Если не удалось создать статью, отправляем урезанную версию сообщения без разметки (обрезка может разорвать ее)
+        return await send(text[:TELEGRAM_MESSAGE_LIMIT])
     except Exception as e:
         logging.error(f"Unexpected error when creating Telegraph article: {e}")
-        # Если произошла непредвиденная ошибка, отправляем урезанную версию сообщения
-        return await message.reply(text[:TELEGRAM_MESSAGE_LIMIT], parse_mode=parse_mode)
+        # Если произошла непредвиденная ошибка, отправляем урезанную версию сообщения без разметки
+        return await send(text[:TELEGRAM_MESSAGE_LIMIT])
+
+# '/command[@bot] [n] [rest]'; n only counts when it is a separate word
+COMMAND_ARGS_RE = re.compile(r'\S+\s*(?:(\d+)(?:\s+|$))?(.*)', re.DOTALL)
+
+def _parse_command(text: str, default: int = DEFAULT_MESSAGE_COUNT, max_n: int = MAX_MESSAGE_COUNT) -> Tuple[int, str]:
+    """
+    Parses the arguments of /history and /qwen into (num_messages, rest).
+    num_messages is default when it is missing or outside 1..max_n.
+    """
+    count, rest = COMMAND_ARGS_RE.match(text).groups()
+    num_messages = int(count) if count else default
+    if not 0 < num_messages <= max_n:
+        num_messages = default
+    return num_messages, rest.strip()
 
 # --- Command Handlers ---
 @dp.message(Command("history"))
 async def handle_history_command(message: Message):
     processing_msg = None
     try:
-        parts = message.text.split()
-        num_messages = DEFAULT_MESSAGE_COUNT
-        if len(parts) > 1 and parts[1].isdigit():
-            num_messages = int(parts[1])
-            if num_messages <= 0 or num_messages > 500:
-                num_messages = DEFAULT_MESSAGE_COUNT
+        num_messages, _ = _parse_command(message.text)
 
         processing_msg = await message.reply(f"Анализирую последние {num_messages} сообщений из сохраненной истории... Это может занять некоторое время.")
 
-        if processing_msg:
-            await save_message_to_db(processing_msg)
-
-        chat_history = get_chat_history_from_db(message.chat.id, num_messages)
+        summary = await run_llm_on_history(message.chat.id, num_messages)
 
-        if not chat_history:
-            if processing_msg:
-                await processing_msg.delete()
-            error_msg = await message.reply("В моей базе данных еще нет сохраненных сообщений из этого чата. Пожалуйста, подождите, пока я их соберу.")
-            await save_message_to_db(error_msg)
+        if summary is None:
+            await processing_msg.edit_text("В моей базе данных еще нет сохраненных сообщений из этого чата. Пожалуйста, подождите, пока я их соберу.")
             return
 
-        formatted_history = "\n".join(
-            [f"{msg['sender_name']} ({msg['date'].strftime('%Y-%m-%d %H:%M:%S')}): {msg['text']}" for msg in chat_history]
-        )
-
-        summary_prompt = (
-            f"Проанализируй следующие сообщения чата, которые идут в хронологическом порядке (сначала самые старые). "
-            f"Предоставь краткую и информативную сводку последних новостей или важных обсуждений. "
-            f"Сосредоточься на ключевых моментах, решениях или обновлениях. Избегай ненужных деталей и 'воды'. "
-            f"Не упоминай, что ты суммируй чат, просто предоставь сводку напрямую на русском языке.\n\n"
-            f"Сообщения чата:\n{formatted_history}\n\n"
-            f"Выводи только финальный ответ, без своих рассуждений."
-        )
-        summary = await call_cerebras_api(summary_prompt, is_qwen_command=False)
+        await send_long_message(processing_msg, summary, parse_mode=ParseMode.MARKDOWN_V2, edit=True)
 
-        if processing_msg:
-            await processing_msg.delete()
-        response_msg = await send_long_message(message, summary, parse_mode=ParseMode.MARKDOWN)
-        await save_message_to_db(response_msg)
-
-    except ValueError:
-        if processing_msg:
-            try:
-                await processing_msg.delete()
-            except Exception as del_e:
-                logging.warning(f"Could not delete processing message in /history ValueError: {del_e}")
-        error_msg = await message.reply(f"Неверное число. Используется значение по умолчанию: {DEFAULT_MESSAGE_COUNT} сообщений.")
-        await save_message_to_db(error_msg)
     except Exception as e:
         logging.error(f"Error in /history command: {e}", exc_info=True)
         if processing_msg:
@@ -363,179 +709,60 @@ async def handle_history_command(message: Message):
                 await processing_msg.delete()
             except Exception as del_e:
                 logging.warning(f"Could not delete processing message in /history Exception: {del_e}")
-        error_msg = await message.reply("Произошла ошибка при попытке обработать команду /history.")
-        await save_message_to_db(error_msg)
+        await message.reply("Произошла ошибка при попытке обработать команду /history.")
 
 @dp.message(Command("qwen"))
 async def handle_qwen_command(message: Message):
     processing_msg = None
     try:
-        parts = message.text.split(maxsplit=2)
-
-        num_messages = DEFAULT_MESSAGE_COUNT
-        user_question = ""
-
-        if len(parts) == 1:
-            await message.reply("Пожалуйста, задайте вопрос после команды /qwen. Например: /qwen Что было решено по проекту?")
-            return
-        elif len(parts) == 2:
-            user_question = parts[1]
-        elif len(parts) == 3:
-            if parts[1].isdigit():
-                num_messages = int(parts[1])
-                if num_messages <= 0 or num_messages > 500:
-                    num_messages = DEFAULT_MESSAGE_COUNT
-                user_question = parts[2]
-            else:
-                user_question = f"{parts[1]} {parts[2]}"
+        num_messages, user_question = _parse_command(message.text)
 
         if not user_question:
-            await message.reply("Пожалуйста, задайте вопрос. Например: /qwen Что было решено по проекту?")
+            await message.reply("Пожалуйста, задайте вопрос после команды /qwen. Например: /qwen Что было решено по проекту?")
             return
 
         processing_msg = await message.reply(f"Ищу в последних {num_messages} сохраненных сообщениях ответ на ваш вопрос... Это может занять некоторое время.")
 
-        chat_history = get_chat_history_from_db(message.chat.id, num_messages)
+        answer = await run_llm_on_history(message.chat.id, num_messages, question=user_question)
 
-        if not chat_history:
-            if processing_msg:
-                await processing_msg.delete()
-            await message.reply("В моей базе данных еще нет сохраненных сообщений из этого чата для ответа на ваш вопрос. Пожалуйста, подождите.")
+        if answer is None:
+            await processing_msg.edit_text("В моей базе данных еще нет сохраненных сообщений из этого чата для ответа на ваш вопрос. Пожалуйста, подождите.")
             return
 
-        formatted_history = "\n".join(
-            [f"{msg['sender_name']} ({msg['date'].strftime('%Y-%m-%d %H:%M:%S')}): {msg['text']}" for msg in chat_history]
-        )
-
-        qwen_prompt = (
-            f"Основываясь *только* на следующих сообщениях чата (в хронологическом порядке, сначала самые старые), "
-            f"пожалуйста, кратко и точно ответь на вопрос пользователя. "
-            f"Если информации в чате нет, четко укажи на это. Отвечай на русском языке.\n\n"
-            f"Сообщения чата:\n{formatted_history}\n\n"
-            f"Вопрос пользователя: {user_question}\n\n"
-            f"Выводи только финальный ответ, без своих рассуждений."
-        )
-        answer = await call_cerebras_api(qwen_prompt, is_qwen_command=True)
-
-        # Post-process the answer to extract only the final response after "Вывод:"
-        if "Вывод:" in answer:
-            answer = answer.split("Вывод:", 1)[1].strip()
-        elif "вывод:" in answer:
-            answer = answer.split("вывод:", 1)[1].strip()
-        elif "Ответ:" in answer:
-            answer = answer.split("Ответ:", 1)[1].strip()
-        elif "ответ:" in answer:
-            answer = answer.split("ответ:", 1)[1].strip()
-        elif "### Ответ" in answer:
-            answer = answer.split("### Ответ", 1)[1].strip()
-        elif "### Ответ:" in answer:
-            answer = answer.split("### Ответ:", 1)[1].strip()
-        elif "### Вывод" in answer:
-            answer = answer.split("### Вывод", 1)[1].strip()
-        elif "### Вывод:" in answer:
-            answer = answer.split("### Вывод:", 1)[1].strip()
-        elif "### Финальный Ответ" in answer:
-            answer = answer.split("### Финальный Ответ", 1)[1].strip()
-        elif "### Финальный Ответ:" in answer:
-            answer = answer.split("### Финальный Ответ:", 1)[1].strip()
-        elif "### Финальный Вывод" in answer:
-            answer = answer.split("### Финальный Вывод", 1)[1].strip()
-        elif "### Финальный Вывод:" in answer:
-            answer = answer.split("### Финальный Вывод:", 1)[1].strip()
-        elif "### Final Answer" in answer:
-            answer = answer.split("### Final Answer", 1)[1].strip()
-        elif "### Final Answer:" in answer:
-            answer = answer.split("### Final Answer:", 1)[1].strip()
-        elif "### Final Response" in answer:
-            answer = answer.split("### Final Response", 1)[1].strip()
-        elif "### Final Response:" in answer:
-            answer = answer.split("### Final Response:", 1)[1].strip()
-        elif "Final Answer:" in answer:
-            answer = answer.split("Final Answer:", 1)[1].strip()
-        elif "Final Response:" in answer:
-            answer = answer.split("Final Response:", 1)[1].strip()
-        elif "Итоговый ответ:" in answer:
-            answer = answer.split("Итоговый ответ:", 1)[1].strip()
-        elif "Итоговый ответ" in answer:
-            answer = answer.split("Итоговый ответ", 1)[1].strip()
-        elif "Итог:" in answer:
-            answer = answer.split("Итог:", 1)[1].strip()
-        elif "итог:" in answer:
-            answer = answer.split("итог:", 1)[1].strip()
-        elif "Решение:" in answer:
-            answer = answer.split("Решение:", 1)[1].strip()
-        elif "решение:" in answer:
-            answer = answer.split("решение:", 1)[1].strip()
-        elif "Результат:" in answer:
-            answer = answer.split("Результат:", 1)[1].strip()
-        elif "результат:" in answer:
-            answer = answer.split("результат:", 1)[1].strip()
-        elif "Заключение:" in answer:
-            answer = answer.split("Заключение:", 1)[1].strip()
-        elif "заключение:" in answer:
-            answer = answer.split("заключение:", 1)[1].strip()
-        elif "Summary:" in answer:
-            answer = answer.split("Summary:", 1)[1].strip()
-        elif "Summary" in answer:
-            answer = answer.split("Summary", 1)[1].strip()
-        elif "Ответ на вопрос:" in answer:
-            answer = answer.split("Ответ на вопрос:", 1)[1].strip()
-        elif "Ответ на вопрос" in answer:
-            answer = answer.split("Ответ на вопрос", 1)[1].strip()
-        elif "###" in answer:
-            parts = answer.split("###", 1)
-            if len(parts) > 1:
-                answer = parts[1].strip()
-        # If none of the above patterns are found, the full answer is sent as is.
-
-        if processing_msg:
-            await processing_msg.delete()
-        try:
-            response_msg = await send_long_message(message, answer, parse_mode=ParseMode.MARKDOWN_V2)
-            await save_message_to_db(response_msg)
-        except Exception as e:
-            logging.warning(f"MarkdownV2 parsing failed, sending plain text: {e}")
-            response_msg = await send_long_message(message, answer)
-            await save_message_to_db(response_msg)
+        await send_long_message(processing_msg, answer, parse_mode=ParseMode.MARKDOWN_V2, edit=True)
 
-    except ValueError:
-        if processing_msg:
-            await processing_msg.delete()
-        error_msg = await message.reply(f"Неверное число. Используется значение по умолчанию: {DEFAULT_MESSAGE_COUNT} сообщений для вашего вопроса.")
-        await save_message_to_db(error_msg)
     except Exception as e:
         logging.error(f"Error in /qwen command: {e}", exc_info=True)
         if processing_msg:
             await processing_msg.delete()
-        error_msg = await message.reply("Произошла ошибка при попытке обработать команду /qwen.")
-        await save_message_to_db(error_msg)
+        await message.reply("Произошла ошибка при попытке обработать команду /qwen.")
 
 # --- Message Handlers ---
-@dp.message(F.text)
+# Commands are handled by specific handlers and are not part of the 'discussion' to summarize,
+# so they are filtered out here along with the bot's own messages and non-group chats.
+@dp.message(
+    F.text
+    & ~F.text.startswith('/')
+    & F.chat.type.in_({'group', 'supergroup'})
+    & (F.from_user.id != bot.id)
+)
 async def handle_all_text_messages(message: Message):
-    """Handles all text messages in chats the bot is part of to save them to the DB."""
-    # Avoid saving bot's own messages or command messages that are already handled
-    if message.from_user.id == bot.id:
-        return
-    if message.text.startswith('/'):
-        # Commands are handled by specific handlers, no need to save them as regular messages
-        # However, if you want to include commands in history, remove this check.
-        # For now, let's assume commands are not part of the 'discussion' to summarize.
-        return
-
-    if message.chat.type in ['group', 'supergroup']:
-        await save_message_to_db(message)
+    """Handles all text messages in groups the bot is part of to save them to the DB."""
+    save_message_to_db(message)
 
 @dp.message(F.new_chat_members)
 async def on_new_chat_members(message: Message):
     """Sends a welcome message when the bot is added to a group."""
     for member in message.new_chat_members:
         if member.id == bot.id:
+            # Escaped like the model's answers: '!', '(' and '.' are reserved in MarkdownV2
             await message.reply(
-                "Всем привет! Я здесь, чтобы помочь.\n\n"
-                f"Используйте `/history [n]` для получения сводки последних `n` сообщений (по умолчанию: {DEFAULT_MESSAGE_COUNT}).\n"
-                f"Используйте `/qwen [n] [ваш вопрос]` чтобы задать вопрос на основе последних `n` сообщений (по умолчанию: {DEFAULT_MESSAGE_COUNT}).\n\n"
-                "Я начинаю сохранять сообщения с этого момента, чтобы анализировать их в будущем.",
+                convert_telegram_markup_to_markdown_v2(
+                    "Всем привет! Я здесь, чтобы помочь.\n\n"
+                    f"Используйте `/history [n]` для получения сводки последних `n` сообщений (по умолчанию: {DEFAULT_MESSAGE_COUNT}).\n"
+                    f"Используйте `/qwen [n] [ваш вопрос]` чтобы задать вопрос на основе последних `n` сообщений (по умолчанию: {DEFAULT_MESSAGE_COUNT}).\n\n"
+                    "Я начинаю сохранять сообщения с этого момента, чтобы анализировать их в будущем."
+                ),
                 parse_mode=ParseMode.MARKDOWN_V2
             )
             break
@@ -543,9 +770,12 @@ async def on_new_chat_members(message: Message):
 # --- Main Function ---
 async def main():
     initialize_db() # Initialize DB before starting polling
-    await bot.delete_webhook(drop_pending_updates=True)
-    logging.info("Starting bot polling...")
-    await dp.start_polling(bot)
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+        logging.info("Starting bot polling...")
+        await dp.start_polling(bot)
+    finally:
+        stop_message_writer()
 
 if __name__ == "__main__":
     try:
@@ -556,5 +786,6 @@ if __name__ == "__main__":
         logging.error(f"An error occurred: {e}")
     finally:
         if not db.is_closed():
+            db.execute_sql('PRAGMA optimize')
             db.close()
             logging.info("Database connection closed.")